@@ -0,0 +1,309 @@
+import os, logging
+import tempfile
+import threading
+import warnings
+import unittest
+from importlib.util import find_spec
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from astropy.io import fits
+from ztfquery import io
+
+logging.getLogger("ztfquery.io").setLevel(logging.DEBUG)
+
+
+class TestFileCheck(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fitsfile = os.path.join(self.tmpdir.name, "good.fits")
+        fits.PrimaryHDU(np.arange(100, dtype="float32").reshape(10, 10)).writeto(
+            self.fitsfile
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_good_fitsfile(self):
+        self.assertFalse(io._is_fitsfile_bad_(self.fitsfile))
+        self.assertFalse(io._is_fitsfile_bad_(self.fitsfile, deep=True))
+
+    def test_truncated_fitsfile(self):
+        truncated = os.path.join(self.tmpdir.name, "truncated.fits")
+        with open(self.fitsfile, "rb") as f:
+            data = f.read()
+        with open(truncated, "wb") as f:
+            f.write(data[: io.FITS_BLOCKSIZE + 100])
+
+        self.assertTrue(io._is_fitsfile_bad_(truncated))
+        self.assertTrue(io._is_fitsfile_bad_(truncated, deep=True))
+
+        # truncated at a block boundary: only seen by the deep check
+        with open(truncated, "wb") as f:
+            f.write(data[: -io.FITS_BLOCKSIZE])
+
+        self.assertFalse(io._is_fitsfile_bad_(truncated))
+        self.assertTrue(io._is_fitsfile_bad_(truncated, deep=True))
+
+    def test_unpadded_fitsfile(self):
+        unpadded = os.path.join(self.tmpdir.name, "unpadded.fits")
+        with open(self.fitsfile, "rb") as f:
+            data = f.read()
+        with open(unpadded, "wb") as f:
+            f.write(data[: io.FITS_BLOCKSIZE + 400]) # 100 float32, no padding
+
+        self.assertTrue(io._is_fitsfile_bad_(unpadded)) # quick: downloaded again
+        self.assertFalse(io._is_fitsfile_bad_(unpadded, deep=True))
+        self.assertTrue(io._test_file_(unpadded))
+        self.assertTrue(os.path.isfile(unpadded))
+
+    def test_gzip_fitsfile(self):
+        import gzip
+        with open(self.fitsfile, "rb") as f:
+            data = gzip.compress(f.read())
+        gzipped = os.path.join(self.tmpdir.name, "good.fits.gz")
+        with open(gzipped, "wb") as f:
+            f.write(data)
+        self.assertFalse(io._is_fitsfile_bad_(gzipped, deep=True))
+
+        with open(gzipped, "wb") as f:
+            f.write(data[: len(data) // 2])
+        self.assertFalse(io._is_fitsfile_bad_(gzipped)) # not checked
+        self.assertTrue(io._is_fitsfile_bad_(gzipped, deep=True))
+        self.assertFalse(io._test_file_(gzipped))
+        self.assertFalse(os.path.isfile(gzipped))
+
+    def test_expected_size(self):
+        size = os.path.getsize(self.fitsfile)
+        self.assertTrue(io._test_file_(self.fitsfile, expected_size=size))
+        self.assertFalse(io._test_file_(self.fitsfile, erasebad=False,
+                                        expected_size=size + 1))
+        self.assertTrue(os.path.isfile(self.fitsfile))
+
+    def test_read_first_block(self):
+        block, size = io._read_first_block_(self.fitsfile)
+        self.assertEqual(size, os.path.getsize(self.fitsfile))
+        with open(self.fitsfile, "rb") as f:
+            self.assertEqual(block, f.read(io.FITS_BLOCKSIZE))
+        # without os.pread (windows)
+        pread = os.pread
+        del os.pread
+        try:
+            self.assertEqual(io._read_first_block_(self.fitsfile), (block, size))
+        finally:
+            os.pread = pread
+
+    def test_not_a_fitsfile(self):
+        notfits = os.path.join(self.tmpdir.name, "notfits.fits")
+        with open(notfits, "wb") as f:
+            f.write(b"<html>error</html>")
+
+        self.assertTrue(io._is_fitsfile_bad_(notfits))
+
+    def test_missing_fitsfile(self):
+        missing = os.path.join(self.tmpdir.name, "missing.fits")
+        self.assertTrue(io._is_fitsfile_bad_(missing))
+        self.assertFalse(io._is_fitsfile_bad_(missing, test_exist=False))
+
+    def test_files_exist(self):
+        missing = os.path.join(self.tmpdir.name, "missing.fits")
+        self.assertListEqual(
+            list(io._files_exist_([self.fitsfile, missing, self.tmpdir.name])),
+            [True, False, False],
+        )
+        # the cached listing is refreshed once the directory changes
+        with open(missing, "wb") as f:
+            f.write(b"")
+        self.assertTrue(io._files_exist_(missing)[0])
+
+    def test_hash_index(self):
+        self.assertFalse(io.hash_for_file_exists(self.fitsfile))
+        io.calculate_and_write_hash(self.fitsfile)
+        self.assertTrue(io.hash_for_file_exists(self.fitsfile))
+        self.assertTrue(os.path.isfile(f"{self.fitsfile}.md5"))
+        self.assertTrue(io.compare_hash(self.fitsfile))
+        self.assertFalse(io.compare_hash(self.fitsfile, computed="0" * 32))
+        self.assertListEqual(
+            io.calculate_hashes([self.fitsfile] * 3, nthreads=2),
+            [io.read_hash(self.fitsfile)] * 3,
+        )
+
+    def test_hash_algo(self):
+        hash_algo = io.HASH_ALGO
+        io.HASH_ALGO = "sha256"
+        try:
+            io.calculate_and_write_hash(self.fitsfile)
+            self.assertTrue(os.path.isfile(f"{self.fitsfile}.sha256"))
+            self.assertEqual(len(io.read_hash(self.fitsfile)), 64)
+            self.assertTrue(io.compare_hash(self.fitsfile))
+            # unavailable algorithm: md5 is used, with a single warning.
+            io.HASH_ALGO = "not_an_algo"
+            with self.assertWarns(UserWarning):
+                self.assertEqual(io._hash_algo_(), "md5")
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                self.assertEqual(io._hash_extension_(), ".md5")
+        finally:
+            io.HASH_ALGO = hash_algo
+        self.assertFalse(io.hash_for_file_exists(self.fitsfile))
+
+    def test_group_writable(self):
+        oldmask = os.umask(0o022)
+        try:
+            subdir = os.path.join(self.tmpdir.name, "sub")
+            with io._group_writable_():
+                os.makedirs(subdir)
+            io.PREALLOCATE_DOWNLOADS = True
+            try:
+                with io._open_for_write_(os.path.join(subdir, "file"), size=100) as f:
+                    f.write(b"10 bytes..")
+            finally:
+                io.PREALLOCATE_DOWNLOADS = False
+            # preallocated space that was not written is cut
+            self.assertEqual(os.path.getsize(os.path.join(subdir, "file")), 10)
+            # the process umask is left untouched
+            self.assertEqual(os.umask(0o022), 0o022)
+            self.assertEqual(os.stat(subdir).st_mode & 0o777, 0o775)
+            self.assertEqual(os.stat(os.path.join(subdir, "file")).st_mode & 0o777, 0o664)
+        finally:
+            os.umask(oldmask)
+
+
+class TestFilename(unittest.TestCase):
+    def test_filedataframe(self):
+        filenames = [
+            "ztf_20190917468333_000698_zi_c03_o_q2_sciimg.fits",
+            "ztf_20190917468333_000698_zg_c13_o_q4_scimrefdiffimg.fits.fz",
+            "ztf_20190917_zr_c03_q2_bias.fits",
+        ]
+        fdata = io.get_filedataframe(filenames)
+        self.assertListEqual(list(fdata["filename"]), filenames)
+        self.assertListEqual(list(fdata["kind"]), ["sci", "sci", "cal"])
+        for i, filename in enumerate(filenames):
+            for key, value in io.parse_filename(filename, as_serie=False).items():
+                self.assertEqual(fdata[key].iloc[i], value)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ answers with the next status of server.statuses (the last one repeats) """
+    def _respond(self, body=True):
+        server = self.server
+        with server.lock:
+            server.nrequests += 1
+            status = server.statuses[min(server.nrequests, len(server.statuses)) - 1]
+
+        content = server.content if status == 200 else b""
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond()
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownload(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.lock = threading.Lock()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/good.fits"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fileout = os.path.join(self.tmpdir.name, "dl", "good.fits")
+        hdu = fits.PrimaryHDU(np.arange(100, dtype="float32").reshape(10, 10))
+        with tempfile.TemporaryFile() as f:
+            hdu.writeto(f)
+            f.seek(0)
+            self.server.content = f.read()
+        self.server.nrequests = 0
+        self.session = io.open_irsa_session(incl_cookies=False)
+        self.session.get_adapter(self.url).max_retries.backoff_factor = 0 # fast retries
+
+    def tearDown(self):
+        self.session.close()
+        self.tmpdir.cleanup()
+
+    def test_irsa_cookies(self):
+        # cookies from other hosts do not count as an irsa login
+        self.session.cookies.set("session", "1", domain="127.0.0.1")
+        self.assertFalse(io._has_irsa_cookies_(self.session))
+        self.session.cookies.set("JOSSO_SESSIONID", "1", domain=io.IRSA_COOKIE_DOMAIN)
+        self.assertTrue(io._has_irsa_cookies_(self.session))
+
+    def test_server_error(self):
+        self.server.statuses = [503]
+        self.assertFalse(io.test_url_exists(self.url, session=self.session,
+                                            cookies="no_cookies"))
+        self.assertEqual(self.server.nrequests, 6) # 5 retries
+        # the last response is returned, nothing is written
+        io.download_single_url(self.url, session=self.session, cookies="no_cookies",
+                               fileout=self.fileout, show_progress=False)
+        self.assertFalse(os.path.exists(self.fileout))
+
+    def test_too_many_requests(self):
+        io._THROTTLING["rate"] = 0.
+        self.server.statuses = [429, 200]
+        io.download_single_url(self.url, session=self.session, cookies="no_cookies",
+                               fileout=self.fileout, show_progress=False)
+        self.assertEqual(self.server.nrequests, 2)
+        self.assertTrue(os.path.isfile(self.fileout))
+        self.assertAlmostEqual(io._THROTTLING["rate"], io._THROTTLING_ALPHA * (1 - io._THROTTLING_ALPHA))
+
+        # only retried by _request_with_backoff_
+        self.server.nrequests = 0
+        self.server.statuses = [429]
+        io.download_single_url(self.url, session=self.session, cookies="no_cookies",
+                               fileout=self.fileout, overwrite=True, show_progress=False)
+        self.assertEqual(self.server.nrequests, 5)
+        io._THROTTLING["rate"] = 0.
+
+    def test_download_url_hashes(self):
+        self.server.statuses = [200]
+        fileouts = [os.path.join(self.tmpdir.name, "dl", f"{i}.fits") for i in range(3)]
+        for nprocess in [1, 2]:
+            io.download_url([self.url] * 3, fileouts, session=self.session,
+                            cookies="no_cookies", show_progress=False, overwrite=True,
+                            nprocess=nprocess, write_hash=True, inline_hash=False)
+            for fileout in fileouts:
+                self.assertTrue(io.compare_hash(fileout))
+                os.remove(f"{fileout}.md5")
+            io._HASH_INDEX.clear()
+
+    @unittest.skipIf(find_spec("httpx") is None, "httpx is not installed")
+    def test_download_many(self):
+        io._THROTTLING["rate"] = 0.
+        self.server.statuses = [429, 200]
+        io.download_many_sync([self.url], [self.fileout], cookies="no_cookies", http2=False)
+        self.assertEqual(self.server.nrequests, 2)
+        self.assertEqual(os.path.getsize(self.fileout), len(self.server.content))
+
+        # existing files are skipped
+        self.server.nrequests = 0
+        self.server.statuses = [200]
+        io.download_many_sync([self.url], [self.fileout], cookies="no_cookies", http2=False)
+        self.assertEqual(self.server.nrequests, 0)
+
+        # downloaded files are checked
+        self.server.content = b"<html>error</html>"
+        io.download_many_sync([self.url], [self.fileout], cookies="no_cookies", http2=False,
+                              overwrite=True)
+        self.assertEqual(self.server.nrequests, 1)
+        self.assertFalse(os.path.exists(self.fileout))
+        io._THROTTLING["rate"] = 0.
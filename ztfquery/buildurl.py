@@ -6,9 +6,12 @@
 https://irsa.ipac.caltech.edu/docs/program_interface/ztf_metadata.html
 """
 import os
+import re
 import warnings
 import numpy as np
 
+from functools import lru_cache
+
 # ========================== #
 #                            #
 #   Generic Query            #
@@ -90,6 +93,12 @@ def get_scifile_of_filename(filename, qid=None, source="irsa"):
 # ================== #
 #  Filename parsing  #
 # ================== #
+# ztf_{filefracday}_{paddedfield}_{filtercode}_c{paddedccdid}_{imgtypecode}_q{qid}_{suffix}
+_SCIFILENAME_RE = re.compile(
+    r"^ztf_(?P<filefracday>\d{14})_(?P<paddedfield>\d{6})_(?P<filtercode>[a-zA-Z]{2})"
+    r"_c(?P<paddedccdid>\d{2})_(?P<imgtypecode>[a-z])_q(?P<qid>\d)_(?P<suffix>.+)$"
+)
+
 def parse_filename(filename):
     """ """
     kind = filename_to_kind(filename)
@@ -578,6 +587,7 @@ def build_filename_from_dataframe(dataframe, suffix="sciimg.fits"):
     )
 
 
+@lru_cache(maxsize=200_000)
 def filename_to_url(filename, suffix=None, source="irsa", kind=None, **kwargs):
     """Generic high level function that first detects the inputfile kind and then
     calls the associated function ; e.g., filename_to_scienceurl or filename_to_calurl.
@@ -614,6 +624,10 @@ def filename_to_url(filename, suffix=None, source="irsa", kind=None, **kwargs):
     -------
     path
         url or local path (see source)
+
+    Note
+    ----
+    Results are cached (functools.lru_cache), so all inputs must be hashable.
     """
     if not os.path.basename(filename).startswith("ztf"):
         return filename  # this is not a normal ztf_ pipeline file.
@@ -638,6 +652,33 @@ def filename_to_url(filename, suffix=None, source="irsa", kind=None, **kwargs):
     raise ValueError(f"Cannot parse the file {filename}")
 
 
+def filename_to_url_bulk(filenames, suffixes=None, **kwargs):
+    """ filename_to_url for every (filename, suffix) combination.
+
+    Parameters
+    ----------
+    filenames: str or list
+        filepath(s) or ztf file name(s).
+
+    suffixes: str, None or list
+        suffix(es) to apply to each filename (see filename_to_url).
+
+    **kwargs goes to filename_to_url (e.g. source, check_suffix)
+
+    Returns
+    -------
+    array
+        urls ordered filename first: [f0_s0, f0_s1, ..., f1_s0, ...]
+    """
+    filenames = np.atleast_1d(filenames).astype(object)
+    suffixes = np.atleast_1d(suffixes).astype(object)
+    fn_grid, sf_grid = np.meshgrid(filenames, suffixes, indexing="ij")
+    # a list of str gives a contiguous '<U{maxlength}' array (not dtype=object)
+    return np.asarray([filename_to_url(filename, suffix=suffix, **kwargs)
+                       for filename, suffix in zip(fn_grid.ravel(), sf_grid.ravel())],
+                      dtype="str")
+
+
 def filename_to_scienceurl(
     filename, suffix=None, source="irsa", verbose=False, check_suffix=False
 ):
@@ -1,17 +1,25 @@
 #!/usr/bin/env python
 #
 
-import os, hashlib, logging, multiprocessing
+import os, hashlib, logging, shutil, stat
 import sys
 import time
+import threading
 import pandas
 import requests
 import warnings
 import numpy as np
 
+from collections.abc import Iterator
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 LOGIN_URL = "https://irsa.ipac.caltech.edu/account/signon/login.do"
+IRSA_COOKIE_DOMAIN = ".ipac.caltech.edu" # domain of the irsa login cookies
 
 import base64
+import hmac
 
 from configparser import ConfigParser
 from astropy.io import fits
@@ -29,6 +37,46 @@ _ENCRYPTING_FILE = os.path.expanduser("~") + "/.queryirsa"
 LOCALSOURCE = os.getenv("ZTFDATA", "./Data/")
 CCIN2P3_SOURCE = "/sps/ztf/data/"
 
+FITS_BLOCKSIZE = 2880
+_FITS_SIGNATURE = b"SIMPLE  ="
+_GZIP_SIGNATURE = b"\x1f\x8b"
+
+_DIRECTORY_LISTINGS = {} # directory -> (mtime_ns, set of file names)
+
+PROGRESSBAR_STEP = 64 # parallel loops update their progress bar every that many files
+PROGRESSBAR_MAXRATE = 10 # maximum number of progress bar updates per second in notebooks
+
+BULK_DASK_THRESHOLD = 8 # bulk_get_file uses dask from that many files to download
+
+MIN_DOWNLOAD_CHUNK = 64 * 1024 # smaller chunks make the copy loop cpu bound
+COPY_BUFFERSIZE = 1024**2 # buffer of the no-progress-bar download copy
+# reserve the disk space of downloads of known size (posix_fallocate).
+# Only for local filesystems supporting it (ext4, xfs...): elsewhere (e.g. nfs)
+# glibc emulates it by writing the whole file, which is then written twice.
+PREALLOCATE_DOWNLOADS = False
+
+HASH_BUFFERSIZE = 1024**2
+# md5, blake3 (if installed) or any hashlib algorithm. 
+# The hash files are named after it (e.g. file.fits.md5)
+HASH_ALGO = os.getenv("ZTFQUERY_HASH", "md5").lower()
+_HASH_INDEX = {} # (directory, hash extension) -> set of file names having a hash file
+
+_IRSA_COOKIES = {} # (username, password) -> irsa login cookies
+
+_DEFAULT_SESSION = None # see _get_default_session()
+_DEFAULT_SESSION_LOCK = threading.Lock()
+
+# Too Many Requests (HTTP 429) handling
+_BACKOFF_BASE = 1 # seconds
+_BACKOFF_CAP = 60 # seconds
+_THROTTLING_ALPHA = 0.1 # moving average weight of the last response
+_THROTTLING_THRESHOLD = 0.01
+_THROTTLING = {"rate": 0., "lock": threading.Lock()}
+
+# downloaded files and directories are group writable, see _group_writable_()
+_SHARED_UMASK = 0o002
+_UMASK = {"count": 0, "saved": None, "lock": threading.Lock()}
+
 logger = logging.getLogger(__name__)
 
 
@@ -90,37 +138,21 @@ def get_file(
     fullpath (or None if not data)
 
     """
-    from .buildurl import filename_to_url
-
-    local_filenames = np.asarray(
-        [
-            filename_to_url(
-                filename_,
-                suffix=suffix_,
-                source="local",
-                check_suffix=check_suffix,
-            )
-            for filename_ in np.atleast_1d(filename)
-            for suffix_ in np.atleast_1d(suffix)
-        ]
-    )
+    from .buildurl import filename_to_url_bulk
+
+    local_filenames = filename_to_url_bulk(filename, suffix, source="local",
+                                           check_suffix=check_suffix)
     if not exist:
         return local_filenames
 
     # local_filenames
-    if overwrite:
-        flag_todl = np.asarray( np.ones( len(local_filenames)), dtype="bool")
-    else:
-        flag_todl = np.asarray(
-            [
-                (not os.path.isfile(f_))
-                or (test_file and ".fits" in f_ and _is_fitsfile_bad_(f_))
-                for f_ in local_filenames
-            ]
-        )
+    flag_todl = _flag_todownload_(local_filenames, overwrite=overwrite, test_file=test_file)
 
     # DL if needed (and wanted)
     if np.any(flag_todl) and downloadit:
+        if session is None:
+            session = _get_default_session()
+            
         if client is not None and wait is None:
             wait = "100"
         if type(wait) is str:
@@ -137,6 +169,7 @@ def get_file(
 
         f_ = download_from_filename(
             local_filenames[flag_todl],
+            precomputed_local=local_filenames[flag_todl],
             session=session,
             show_progress=show_progress,
             host=dlfrom,
@@ -165,6 +198,53 @@ def get_file(
     return local_filenames
 
 
+def _flag_todownload_(local_filenames, overwrite=False, test_file=True):
+    """ boolean array flagging the local files that are missing (or bad) """
+    if overwrite:
+        return np.ones(len(local_filenames), dtype="bool")
+    
+    return np.fromiter(
+            (
+                (not isfile_)
+                or (test_file and ".fits" in f_ and _is_fitsfile_bad_(f_))
+                for f_, isfile_ in zip(local_filenames, _files_exist_(local_filenames))
+            ), dtype="bool", count=len(local_filenames)
+        )
+
+
+def _list_directory_(directory):
+    """ set of the file names contained in the given directory.
+
+    The listing is cached and only re-read when the directory
+    modification time changed.
+    """
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except OSError:
+        return set()
+
+    cached = _DIRECTORY_LISTINGS.get(directory)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    with os.scandir(directory) as entries:
+        names = {entry.name for entry in entries if entry.is_file()}
+
+    _DIRECTORY_LISTINGS[directory] = (mtime_ns, names)
+    return names
+
+
+def _files_exist_(filenames):
+    """ equivalent to [os.path.isfile(f) for f in filenames] 
+    but reading each directory only once.
+    """
+    filenames = np.atleast_1d(filenames)
+    listings = {dirname: _list_directory_(dirname or ".")
+                for dirname in set(map(os.path.dirname, filenames))}
+    return np.fromiter((os.path.basename(f_) in listings[os.path.dirname(f_)]
+                        for f_ in filenames), dtype="bool", count=len(filenames))
+
+
 def filefracday_to_local_rawdata(filefracday, ccdid="*"):
     """ """
     from glob import glob
@@ -201,6 +281,9 @@ def bulk_get_file(filenames, client=None, suffix=None,
          - futures
          - gathered
          - computed
+         For computed and gathered, dask is not used if all files are
+         already there, nor if less than BULK_DASK_THRESHOLD files have
+         to be downloaded (and no client is given).
     
     Return
     ------
@@ -210,15 +293,48 @@ def bulk_get_file(filenames, client=None, suffix=None,
         - delayed of futures will return in addition the session that should eventually be closed.
           -> list_of_file, session
     """
-    import dask
-
-    session = open_irsa_session()
-
     if client is None and as_dask in ["gather", "gathered"]:
         as_dask = "compute"
+
+    test_file = kwargs.pop("test_file", True)
+
+    # - No need for dask if (almost) everything is already here.
+    if as_dask in ["computed", "compute", "gathered", "gather"]:
+        from .buildurl import filename_to_url_bulk
         
+        local_filenames = filename_to_url_bulk(filenames, suffix, source="local",
+                                               check_suffix=kwargs.get("check_suffix", True))
+        # local files are ordered filename first (see filename_to_url_bulk)
+        flag_todl = _flag_todownload_(local_filenames,
+                                      overwrite=kwargs.get("overwrite", False),
+                                      test_file=test_file
+                                      ).reshape(len(np.atleast_1d(filenames)), -1).any(axis=1)
+        n_todl = np.sum(flag_todl)
+        # files already tested above are not tested again by get_file.
+        if n_todl == 0:
+            return [get_file(filename, suffix=suffix, show_progress=False, maxnprocess=1,
+                                 test_file=False, **kwargs)
+                        for filename in filenames]
+        
+        if n_todl < BULK_DASK_THRESHOLD and client is None:
+            session = open_irsa_session(maxnprocess=n_todl)
+            with ThreadPoolExecutor(max_workers=n_todl) as p:
+                results = list(p.map(lambda filename, todl: get_file(filename, suffix=suffix,
+                                                                     session=session,
+                                                                     show_progress=False,
+                                                                     maxnprocess=1,
+                                                                     test_file=test_file and todl,
+                                                                     **kwargs),
+                                     filenames, flag_todl))
+            session.close()
+            return results
+
+    import dask
+    session = open_irsa_session()
+    
     d_files = [ dask.delayed(get_file)(filename, suffix=suffix, session=session,
-                                show_progress=False, maxnprocess=1,**kwargs)
+                                show_progress=False, maxnprocess=1, test_file=test_file,
+                                **kwargs)
                 for filename in filenames]
         
     if as_dask == "delayed":
@@ -250,11 +366,43 @@ def bulk_get_file(filenames, client=None, suffix=None,
 def get_filedataframe(filenames):
     """get a dataframe of the files"""
     import pandas
-
-    fileserie = pandas.Series(filenames, name="filename")
-
-    fdata = pandas.DataFrame.from_records(fileserie.apply(parse_filename))
-    fdata["isfile"] = fileserie.apply(os.path.isfile)
+    from .buildurl import _SCIFILENAME_RE, FILTERS
+    from .fields import ccdid_qid_to_rcid
+
+    fileserie = pandas.Series(filenames, name="filename", dtype=object)
+    basenames = fileserie.str.rsplit("/", n=1).str[-1]
+
+    # - science files, parsed at once.
+    scidata = basenames.str.extract(_SCIFILENAME_RE)
+    is_sci = scidata["filefracday"].notna()
+    scidata = scidata[is_sci]
+    filefracday = scidata["filefracday"]
+    ccdid = scidata["paddedccdid"].astype(int)
+    qid = scidata["qid"].astype(int)
+    scidata = pandas.DataFrame({"year": filefracday.str[:4],
+                                "month": filefracday.str[4:6],
+                                "day": filefracday.str[6:8],
+                                "imgtypecode": scidata["imgtypecode"],
+                                "filefracday": filefracday,
+                                "fracday": filefracday.str[8:],
+                                "paddedfield": scidata["paddedfield"],
+                                "field": scidata["paddedfield"].astype(int),
+                                "ccdid": ccdid,
+                                "qid": qid,
+                                "rcid": ccdid_qid_to_rcid(ccdid, qid),
+                                "filtercode": scidata["filtercode"],
+                                "filterid": scidata["filtercode"].map(FILTERS),
+                                "kind": "sci",
+                                "suffix": scidata["suffix"]},
+                                index=scidata.index)
+
+    # - other files (raw, cal, unknown), parsed one by one.
+    otherdata = pandas.DataFrame.from_records(
+        [parse_filename(f_, as_serie=False) for f_ in fileserie[~is_sci]],
+        index=fileserie.index[~is_sci])
+
+    fdata = pandas.concat([scidata, otherdata]).reindex(fileserie.index)
+    fdata["isfile"] = _files_exist_(fileserie.values)
     merged = fdata.merge(fileserie, left_index=True, right_index=True)
     return merged
 
@@ -262,7 +410,7 @@ def get_filedataframe(filenames):
 def filename_to_kind(filename):
     """ get the kind given the filename
     
-    this using buildurl.filename_to_kind()
+    this follows buildurl.filename_to_kind() (vectorized for lists)
 
     Parameters
     ----------
@@ -278,7 +426,17 @@ def filename_to_kind(filename):
     from .buildurl import filename_to_kind
     if type(filename) is str:
         return filename_to_kind(filename)
-    return [filename_to_kind(filename_) for filename_ in filename]
+
+    # same rules as buildurl.filename_to_kind, applied to all filenames at once.
+    filename = pandas.Series(np.atleast_1d(filename), dtype=object)
+    nparts = filename.str.rsplit("/", n=1).str[-1].str.count("_").to_numpy() + 1
+    iscal = filename.str.contains("_hifreq|_bias", regex=True).to_numpy(dtype="bool")
+    kind = np.select([nparts >= 8, (nparts == 6) & iscal, nparts == 6],
+                     ["sci", "cal", "raw"], default=None)
+    if np.any(kind == None):
+        warnings.warn(f"Cannot parse {np.sum(kind == None)} files ; remark 'ref' not implemented.")
+        
+    return kind.tolist()
         
     
 def parse_filename(filename, as_serie=True):
@@ -321,6 +479,7 @@ def download_from_filename(
     check_suffix=True,
     client=None,
     wait=None,
+    precomputed_local=None,
     **kwargs,
     ):
     """ Download the file associated to the given filename 
@@ -330,41 +489,36 @@ def download_from_filename(
     session: requests.Session
         session used to call the get method
 
+    precomputed_local: list
+        local filepath associated to each filename (if already known).
+        If None, this is derived from the filenames.
 
     """
     if host not in ["irsa", "ccin2p3"]:
         raise ValueError(f"Only 'irsa' and 'ccin2p3' host implemented: {host} given")
 
-    from .buildurl import filename_to_url
-
-    remote_filename = []
-    local_filename = []
-    for file_ in np.atleast_1d(filename):
-        remote_filename.append(
-            filename_to_url(
-                file_,
-                suffix=suffix,
-                source=host,
-                check_suffix=check_suffix,
-            )
-        )
-        local_filename.append(
-            filename_to_url(
-                file_,
-                suffix=suffix,
-                source="local",
-                check_suffix=check_suffix,
-            )
-        )
+    from .buildurl import filename_to_url_bulk
+
+    remote_filename = list(filename_to_url_bulk(filename, suffix, source=host,
+                                                check_suffix=check_suffix))
+    if precomputed_local is not None:
+        local_filename = list(np.atleast_1d(precomputed_local))
+    else:
+        local_filename = list(filename_to_url_bulk(filename, suffix, source="local",
+                                                   check_suffix=check_suffix))
 
     if nodl:
         return [remote_filename, local_filename]
 
     nprocess = np.min([maxnprocess, len(local_filename)])
-    # cookies:
-    if auth is None:
-        auth = None, None # no username, no password
-    cookies = get_cookie(*auth, session=session, update=False)
+    if session is None:
+        session = _get_default_session()
+        
+    # cookies: attached to the session (if not already there)
+    if not _has_irsa_cookies_(session):
+        if auth is None:
+            auth = None, None # no username, no password
+        _ = get_cookie(*auth, session=session, update=False)
     
     return download_url(
             remote_filename,
@@ -374,7 +528,6 @@ def download_from_filename(
             client=client,
             wait=wait,
             overwrite=overwrite,
-            cookies=cookies,
             show_progress=show_progress,
             **kwargs)
 
@@ -388,8 +541,8 @@ def _parse_filename_(filename, builddir=False, squeeze=True, exists=False):
     # extension = filename.split(".")[-1]
 
     if builddir:
-        oldmask = os.umask(0o002)
-        os.makedirs(directory, exist_ok=True)
+        with _group_writable_():
+            os.makedirs(directory, exist_ok=True)
 
     # unique object
     if "*" in filename and not exists:
@@ -406,9 +559,12 @@ def _parse_filename_(filename, builddir=False, squeeze=True, exists=False):
 
     return localfile
 
-def open_irsa_session(auth=None, incl_cookies=True):
+def open_irsa_session(auth=None, incl_cookies=True, maxnprocess=16):
     """ open a session that has irsa cookies 
 
+    The session keeps its connections alive (urllib3 connection pool)
+    such that successive downloads do not pay a new TCP+TLS handshake.
+
     Parameters
     ----------
     auth: list
@@ -417,11 +573,28 @@ def open_irsa_session(auth=None, incl_cookies=True):
     incl_cookies: bool
         should the session acquire irsa login cookies ?
 
+    maxnprocess: int
+        maximum number of parallel downloads expected to use this session.
+        This sets the connection pool size.
+
     Returns
     -------
     requests.Session
     """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     session = requests.Session()
+    retries = Retry(total=5, backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504],
+                    # 429 is left to _request_with_backoff_, whatever the Retry-After.
+                    respect_retry_after_header=False,
+                    raise_on_status=False) # return the last response, as without retries
+    adapter = HTTPAdapter(pool_connections=32,
+                          pool_maxsize=max(32, maxnprocess * 2),
+                          max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
 
     if incl_cookies:
         if auth is None:
@@ -430,11 +603,28 @@ def open_irsa_session(auth=None, incl_cookies=True):
 
     return session
 
+def _get_default_session():
+    """ session used when none is given.
+
+    It is created at the first call and then kept (and its connections alive) 
+    for the lifetime of the python process.
+    """
+    global _DEFAULT_SESSION
+    with _DEFAULT_SESSION_LOCK:
+        if _DEFAULT_SESSION is None:
+            _DEFAULT_SESSION = open_irsa_session(incl_cookies=False)
+            _DEFAULT_SESSION.headers["Connection"] = "keep-alive"
+            
+    return _DEFAULT_SESSION
+
 # ================= #
 #  Crypting         #
 # ================= #
+@lru_cache(maxsize=8)
 def _load_id_(which, askit=True, token_based=False):
-    """returns login information for the requested enty"""
+    """returns login information for the requested enty
+    (cached, the cache is cleared by set_account)
+    """
     import base64
 
     config = ConfigParser()
@@ -542,16 +732,24 @@ def set_account(
     with open(_ENCRYPT_FILE, "w") as configfile:
         config.write(configfile)
 
+    _load_id_.cache_clear()
+
 
 #
 # TEST
 #
 # - Password testing
+def _has_irsa_cookies_(session):
+    """ does the session hold irsa login cookies ? 
+    (sessions may hold cookies from other hosts, see _get_default_session)
+    """
+    return IRSA_COOKIE_DOMAIN in session.cookies.list_domains()
+
 def test_irsa_account(auth=None, **kwargs):
     """returns True if the IRSA account is correctly set."""
     if auth is None:
         auth = _load_id_("irsa")
-    return ".ipac.caltech.edu" in get_cookie(*auth, **kwargs)._cookies
+    return IRSA_COOKIE_DOMAIN in get_cookie(*auth, **kwargs)._cookies
 
 # - File testing
 def get_localfiles(extension="*", startpath=None):
@@ -572,14 +770,32 @@ def get_localfiles(extension="*", startpath=None):
     -------
     list of file.
     """
-    from glob import glob
-
     if startpath is None:
         startpath = LOCALSOURCE
     if extension.startswith("."):
         extension = extension[1:]
 
-    return [f for f in glob(startpath + f"**/*.{extension}", recursive=True)]
+    return list(_iter_localfiles_(startpath, extension))
+
+
+def _iter_localfiles_(directory, extension="*"):
+    """ yields, recursively, the files of the directory having the given extension.
+    Like glob, hidden files and directories are ignored.
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                yield from _iter_localfiles_(entry.path, extension)
+            elif (extension == "*" and "." in entry.name) or \
+                  entry.name.endswith(f".{extension}"):
+                yield entry.path
 
 
 def run_full_filecheck(
@@ -589,6 +805,7 @@ def run_full_filecheck(
     redownload=False,
     nprocess=4,
     show_progress=True,
+    deep=True,
     **kwargs,
 ):
     """Look for all file with the given extension recursively starting from `startpath` and checks if the file
@@ -619,26 +836,46 @@ def run_full_filecheck(
         Number of paralell processing
 
     show_progress: [bool] -optional-
-        Do you want to show the progress bar ?
+        Do you want to show the progress bar of the redownload ?
+        There is none for the checks: files are checked while the directories 
+        are walked through, so their number is only known (and logged) at the end.
+
+    deep: [bool] -optional-
+        Should fits files be fully loaded ? 
+        If False, only their first header block is read (fast).
 
     Returns
     -------
     list of corrupted/bad files (might already be removed, see erasebad)
 
     """
-    all_ztffiles = get_localfiles(extension=extension, startpath=startpath)
-    logger.info(f"{len(all_ztffiles)} files to check")
+    if startpath is None:
+        startpath = LOCALSOURCE
+    if extension.startswith("."):
+        extension = extension[1:]
+
+    # files are checked while the directories are being walked through.
+    nfiles = 0
+    def _count_(files):
+        nonlocal nfiles
+        for f in files:
+            nfiles += 1
+            yield f
+            
+    _HASH_INDEX.clear() # hash files are re-indexed as directories are met.
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         badfiles = test_files(
-            all_ztffiles,
+            _count_(_iter_localfiles_(startpath, extension)),
             erasebad=erasebad,
             nprocess=nprocess,
             show_progress=show_progress,
             redownload=redownload,
+            deep=deep,
             **kwargs,
         )
 
+    logger.info(f"{nfiles} files checked")
     return badfiles
 
 
@@ -648,6 +885,7 @@ def test_files(
     nprocess=1,
     show_progress=True,
     redownload=False,
+    deep=True,
     **kwargs,
     ):
     """
@@ -655,7 +893,8 @@ def test_files(
     Parameters
     ----------
     filename: [fiulepath or list of]
-        File(s) to be checked.
+        File(s) to be checked. 
+        This can also be an iterator (no progress bar shown then).
 
     erasebad: [bool] -optional-
         Do you want to remove from your local directory the corrupted files ?
@@ -670,6 +909,10 @@ def test_files(
     show_progress: [bool] -optional-
         Do you want to show the progress bar ?
 
+    deep: [bool] -optional-
+        Should fits files be fully loaded ? 
+        If False, only their first header block is read (fast).
+
     **kwargs goes to _test_file_: write_hask
 
     Returns
@@ -682,36 +925,36 @@ def test_files(
     elif nprocess < 1:
         raise ValueError("nprocess must 1 or higher (None means 1)")
 
-    filename = np.atleast_1d(filename)
+    if not isinstance(filename, Iterator):
+        filename = np.atleast_1d(filename)
 
     if nprocess == 1:
         fileissue = [
             f
             for f in filename
-            if not _test_file_(f, erasebad=erasebad, redownload=redownload, **kwargs)
+            if not _test_file_(f, erasebad=erasebad, redownload=redownload, deep=deep,
+                                   **kwargs)
         ]
     else:
-        import multiprocessing
-
-        if show_progress:
+        if show_progress and not isinstance(filename, Iterator):
             from astropy.utils.console import ProgressBar
 
             bar = ProgressBar(len(filename), ipython_widget=is_running_from_notebook())
         else:
             bar = None
 
-        erasebad_ = [erasebad] * len(filename)
-        fileissue = []
+        def _test_(filename_):
+            return filename_, _test_file_(filename_, erasebad=erasebad, deep=deep,
+                                          write_hash=kwargs.get("write_hash", False))
 
-        with multiprocessing.Pool(nprocess) as p:
+        update_bar = _progressbar_updater_(bar)
+        fileissue = []
+        with ThreadPoolExecutor(max_workers=nprocess) as p:
             # Da Loop
-            for j, isgood in enumerate(
-                p.imap(_test_file_multiprocess_, zip(filename, erasebad_))
-            ):
-                if bar is not None:
-                    bar.update(j)
+            for j, (filename_, isgood) in enumerate(p.map(_test_, filename)):
+                update_bar(j)
                 if not isgood:
-                    fileissue.append(filename[j])
+                    fileissue.append(filename_)
 
             if bar is not None:
                 bar.update(len(filename))
@@ -750,10 +993,24 @@ def test_files(
         return fileissue
 
 
-def _test_file_multiprocess_(args):
-    """ """
-    filename, erasebad = args
-    return _test_file_(filename, erasebad=erasebad, fromdl=False, redownload=False)
+def _progressbar_updater_(bar, step=PROGRESSBAR_STEP):
+    """ returns a function f(j) that updates the progress bar only every `step` j 
+    (and, in notebooks, at most PROGRESSBAR_MAXRATE times per second).
+    """
+    if bar is None:
+        return lambda j: None
+    
+    mininterval = 1 / PROGRESSBAR_MAXRATE if is_running_from_notebook() else 0
+    lastupdate = [-np.inf]
+    def update(j):
+        if j % step != 0:
+            return
+        now = time.monotonic()
+        if now - lastupdate[0] >= mininterval:
+            bar.update(j)
+            lastupdate[0] = now
+            
+    return update
 
 
 def _are_fitsfiles_bad_(filenames, test_exist=True):
@@ -761,17 +1018,88 @@ def _are_fitsfiles_bad_(filenames, test_exist=True):
     return [_is_fitsfile_bad_(f_, test_exist=test_exist) for f_ in filenames]
 
 
-def _is_fitsfile_bad_(filename, test_exist=True):
-    """ """
-    if not os.path.isfile(filename):
+def _read_first_block_(filename, blocksize=FITS_BLOCKSIZE):
+    """ returns the first `blocksize` bytes of the file and the file size.
+    (single unbuffered read)
+    """
+    if not hasattr(os, "pread"): # windows
+        with open(filename, "rb", buffering=0) as f:
+            return f.read(blocksize), os.fstat(f.fileno()).st_size
+        
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        return os.pread(fd, blocksize, 0), os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+
+def _is_fitsfile_bad_(filename, test_exist=True, deep=False):
+    """ check if the given fits file is corrupted.
+
+    By default, this only reads the first fits block (2880 bytes) and checks
+    the fits signature and that the file size is a multiple of the block size
+    (truncated downloads are not, nor, sometimes, readable files lacking 
+    their final padding; these are accepted by the deep check).
+
+    Parameters
+    ----------
+    filename: str
+        path of the fits file
+
+    test_exist: bool
+        value returned if the file does not exist.
+
+    deep: bool
+        should all the headers be checked, as well as the extent
+        of all data units compared to the file size ?
+        This is done instead of the block size check, if the fits
+        signature is found.
+        (data are never loaded, but gzip compressed files are 
+        decompressed once to check their integrity and size)
+
+    Returns
+    -------
+    bool
+    """
+    try:
+        block, size = _read_first_block_(filename)
+    except FileNotFoundError:
         return test_exist
+    except OSError:
+        return True
+
+    # gzip compressed fits cannot be checked from the header.
+    is_gzip = block.startswith(_GZIP_SIGNATURE)
+    if not is_gzip and not block.startswith(_FITS_SIGNATURE):
+        return True
+
+    if not deep:
+        return not is_gzip and size % FITS_BLOCKSIZE != 0
 
     try:
-        _ = fits.getdata(filename)
-        return False
+        if is_gzip: # raises if truncated or corrupted.
+            size = _gunzipped_size_(filename)
+            
+        # the with statement closes the file and memory map right away.
+        with fits.open(filename, memmap=True, lazy_load_hdus=True) as hdul:
+            hdul.verify("silentfix+exception")
+            _ = hdul[0].header["NAXIS"]
+            lastinfo = hdul.fileinfo(len(hdul) - 1) # reads all headers
+            # the final padding (included in datSpan) may be missing.
+            return lastinfo["datLoc"] + hdul[-1].size > size
     except:
         return True
 
+def _gunzipped_size_(filename):
+    """ size of the decompressed content of a gzip file 
+    (the whole file is decompressed, by chunks) """
+    import gzip
+    size = 0
+    with gzip.open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFERSIZE), b""):
+            size += len(chunk)
+    return size
+
 def _is_textfile_bad_(filename):
     """ """
     try:
@@ -781,19 +1109,40 @@ def _is_textfile_bad_(filename):
         return True
 
 
-def _test_file_(filename, erasebad=True, fromdl=False, redownload=False, write_hash=False):
-    """ """
+def _test_file_(filename, erasebad=True, fromdl=False, redownload=False, write_hash=False,
+                deep=True, hexdigest=None, expected_size=None):
+    """ hexdigest: hexdigest of the file, if already known (see write_hash) 
+    expected_size: size (in bytes) the file should have (e.g. from the 
+                   download Content-Length), the file is bad otherwise.
+    """
     propissue = dict(erasebad=erasebad, fromdl=fromdl, redownload=redownload)
+    # a stored hash that differs from the given one is outdated: test again.
+    try:
+        has_hash = hash_for_file_exists(filename) and (
+            hexdigest is None or compare_hash(filename, computed=hexdigest))
+    except FileNotFoundError: # hash file removed meanwhile
+        has_hash = False
+    
+    if expected_size is not None:
+        try:
+            size = os.stat(filename).st_size
+        except FileNotFoundError:
+            logger.debug(f"[Errno 2] No such file or directory: {filename}")
+            return True
+        if size != expected_size:
+            # truncated: no need to go any further.
+            logger.debug(f"{filename} has {size} bytes, {expected_size} expected")
+            _fileissue_(filename, **propissue)
+            return False
 
     if ".fits" in filename:
-        if not hash_for_file_exists(filename):
+        if not has_hash:
             try:
-                _ = fits.getdata(filename)
+                if _is_fitsfile_bad_(filename, test_exist=False, deep=deep):
+                    raise OSError(f"{filename} is not a valid fits file")
                 if write_hash:
-                    calculate_and_write_hash(filename)
-                else:
-                    calculate_hash(filename)
-                    
+                    calculate_and_write_hash(filename, hexdigest=hexdigest)
+
             except FileNotFoundError:
                 logger.debug(f"[Errno 2] No such file or directory: {filename}")
             except:
@@ -801,13 +1150,11 @@ def _test_file_(filename, erasebad=True, fromdl=False, redownload=False, write_h
                 return False
 
     elif ".txt" in filename:
-        if not hash_for_file_exists(filename):
+        if not has_hash:
             try:
                 _ = open(filename).read().splitlines()
                 if write_hash:
-                    calculate_and_write_hash(filename)
-                else:
-                    calculate_hash(filename)
+                    calculate_and_write_hash(filename, hexdigest=hexdigest)
             except FileNotFoundError:
                 logger.debug(f"[Errno 2] No such file or directory: {filename}")
             except:
@@ -874,39 +1221,174 @@ def get_cookie(username=None, password=None, session=None, update=False):
         If not, then nothing happens here.
     """
     # has a session that has cookies, should this update ?
-    if session is not None and len(session.cookies)>0 and not update:
+    if session is not None and _has_irsa_cookies_(session) and not update:
         return
 
     if username is None or password is None:
         username, password = _load_id_("irsa")
+
+    # already logged in, reuse the cookies.
+    if update:
+        _ = _IRSA_COOKIES.pop((username, password), None)
+    elif (username, password) in _IRSA_COOKIES:
+        cookies = _IRSA_COOKIES[(username, password)]
+        if session is None:
+            return cookies
+        session.cookies.update(cookies)
+        return session.cookies
     
     url = "%s?josso_cmd=login&josso_username=%s&josso_password=%s" % (
         LOGIN_URL,
         username,
         password,
     )
-    if session is not None:
+    if session is None: # temporary session, closed once logged in.
+        with requests.Session() as session:
+            _ = session.get(url)
+            cookies = session.cookies.copy()
+    else:
         _ = session.get(url) # this attach the cookies to the session
+        cookies = session.cookies
         
-    return requests.get(url).cookies # the returns the cookies
+    if IRSA_COOKIE_DOMAIN in cookies.list_domains(): # logged in
+        _IRSA_COOKIES[(username, password)] = cookies.copy()
+        
+    return cookies # the returns the cookies
+
 
+def _expected_size_(response):
+    """ size (in bytes) of the file written from response if given 
+    by its headers, None otherwise. """
+    if response.status_code != 200:
+        return None
+    # with a Content-Encoding, Content-Length is that of the encoded data.
+    if response.headers.get("content-encoding", "identity") != "identity":
+        return None
+    try:
+        return int(response.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+
+    
+@contextmanager
+def _group_writable_():
+    """ temporarily set the process umask to _SHARED_UMASK.
 
-def _download_(args):
-    """To be used within _ZTFDownloader_.download_data()
-    url, fileout,overwrite = args
+    The previous umask is restored once the last concurrent user
+    (e.g. download threads) exits the context.
     """
-    url, fileout, session, overwrite, wait, cutouts, ra, dec, cutout_size = args
-
-    download_single_url(
-        url,
-        fileout=fileout,
-        session=session,
-        overwrite=overwrite,
-        wait=wait,
-        cutouts=cutouts,
-        radec=[ra, dec],
-        cutout_size=cutout_size,
-    )
+    with _UMASK["lock"]:
+        if _UMASK["count"] == 0:
+            _UMASK["saved"] = os.umask(_SHARED_UMASK)
+        _UMASK["count"] += 1
+    try:
+        yield
+    finally:
+        with _UMASK["lock"]:
+            _UMASK["count"] -= 1
+            if _UMASK["count"] == 0:
+                os.umask(_UMASK["saved"])
+
+                
+@contextmanager
+def _open_for_write_(filename, size=None):
+    """ open filename in 'wb' mode, created group writable. 
+    The kernel is told that the file is to be accessed sequentially
+    and, if size is given and PREALLOCATE_DOWNLOADS, size bytes are 
+    allocated upfront.
+    """
+    with _group_writable_():
+        f = open(filename, "wb")
+
+    with f:
+        if hasattr(os, "posix_fadvise"): # not on windows nor macos
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError: # only a hint
+                pass
+            
+        if not PREALLOCATE_DOWNLOADS or not hasattr(os, "posix_fallocate"):
+            size = None
+            
+        if size:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError: # e.g. no space left, the file is truncated anyway.
+                pass
+                
+        try:
+            yield f
+        finally:
+            if size: # the file was extended to size, cut what was not written.
+                f.truncate()
+
+    
+def _parse_retry_after_(retry_after):
+    """ convert a Retry-After header value (seconds or http-date) into seconds """
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    
+    from email.utils import parsedate_to_datetime
+    try:
+        date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+def _update_throttling_(throttled):
+    """ update the moving average of the rate of 'Too Many Requests' responses """
+    with _THROTTLING["lock"]:
+        _THROTTLING["rate"] = ((1 - _THROTTLING_ALPHA) * _THROTTLING["rate"]
+                               + _THROTTLING_ALPHA * float(throttled))
+
+
+def _request_with_backoff_(request, url, maxtry=5, **kwargs):
+    """ call request(url, **kwargs) and retry upon HTTP 429 (Too Many Requests).
+
+    The waiting time is that given by the Retry-After header if any,
+    otherwise it follows a decorrelated jitter backoff.
+
+    Parameters
+    ----------
+    request: func
+        method doing the request, e.g. session.get
+
+    url: str
+        requested url
+
+    maxtry: int
+        maximum number of requests.
+
+    **kwargs goes to request
+
+    Returns
+    -------
+    requests.Response
+    """
+    sleep = _BACKOFF_BASE
+    for i in range(maxtry):
+        response = request(url, **kwargs)
+        throttled = response.status_code == 429
+        _update_throttling_(throttled)
+        if not throttled or i == maxtry - 1:
+            break
+
+        retry_after = _parse_retry_after_(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            sleep = retry_after
+        else:
+            sleep = np.random.uniform(_BACKOFF_BASE, min(_BACKOFF_CAP, sleep * 3))
+
+        logger.debug(f"too many requests for {url}, retrying in {sleep:.1f}s")
+        response.close()
+        time.sleep(sleep)
+
+    return response
 
 
 def download_url(
@@ -927,6 +1409,12 @@ def download_url(
     **kwargs,
     ):
     """ """
+    if session is None:
+        session = _get_default_session()
+
+    if cookies is None and not _has_irsa_cookies_(session):
+        # log in once, before the session is shared by parallel downloads.
+        _ = get_cookie(session=session, update=False)
     #
     # - Dask Client
     if client is not None:
@@ -958,11 +1446,18 @@ def download_url(
     elif nprocess < 1:
         raise ValueError("nprocess must 1 or higher (None means 1)")
 
+    # hashes not computed while downloading are computed afterwards, all at once.
+    bulk_hash = (kwargs.get("write_hash", False) and kwargs.get("filecheck", True)
+                     and not kwargs.get("inline_hash", True))
+    if bulk_hash:
+        kwargs["write_hash"] = False
+
     if nprocess == 1:
         # Single processing
         logger.debug("No parallel downloading")
+        isgood = []
         for url, fileout in zip(to_download_urls, download_location):
-            download_single_url(
+            isgood.append(download_single_url(
                 url,
                 cutouts=cutouts,
                 fileout=fileout,
@@ -974,10 +1469,10 @@ def download_url(
                 cutout_size=cutout_size,
                 wait=wait,
                 **kwargs,
-            )
+            ))
 
     else:
-        # Multi processing
+        # Multi threading (downloads are I/O bound and share the session pool)
         if show_progress:
             from astropy.utils.console import ProgressBar
 
@@ -987,44 +1482,51 @@ def download_url(
         else:
             bar = None
 
-        logger.debug("parallel downloading ; asking for %d processes" % nprocess)
-
-        # Passing arguments
-        overwrite_ = [overwrite] * len(to_download_urls)
-        wait_ = [wait] * len(to_download_urls)
-        cutouts_ = [cutouts] * len(to_download_urls)
-        session = [session] * len(to_download_urls)
-        if radec is  None:
-            radec = [None,None]
-        
-        ra_ = [radec[0]] * len(to_download_urls)
-        dec_ = [radec[1]] * len(to_download_urls)
-        cutout_size_ = [cutout_size] * len(to_download_urls)
-
-        args = zip(
-            to_download_urls,
-            download_location,
-            session,
-            overwrite_,
-            wait_,
-            cutouts_,
-            ra_,
-            dec_,
-            cutout_size_,
-        )
+        logger.debug("parallel downloading ; asking for %d threads" % nprocess)
         if pool is None:
             close_pool = True
-            pool = multiprocessing.Pool(nprocess)
+            pool = ThreadPoolExecutor(max_workers=nprocess)
         else:
             close_pool = False
-            
+
+        futures = [
+            pool.submit(
+                download_single_url,
+                url,
+                cutouts=cutouts,
+                fileout=fileout,
+                session=session,
+                show_progress=False,
+                overwrite=overwrite,
+                cookies=cookies,
+                radec=radec,
+                cutout_size=cutout_size,
+                wait=wait,
+                **kwargs,
+            )
+            for url, fileout in zip(to_download_urls, download_location)
+        ]
         # Da Loop
-        for j, result in enumerate( pool.imap_unordered(_download_, args) ):
+        update_bar = _progressbar_updater_(bar)
+        try:
+            for j, future in enumerate(as_completed(futures)):
+                future.result()
+                update_bar(j)
+                
             if bar is not None:
-                bar.update(j)
+                bar.update(len(futures))
+        finally:
+            if close_pool:
+                pool.shutdown(wait=True)
                 
-        if close_pool:
-            pool.close()
+        isgood = [future.result() for future in futures]
+
+    if bulk_hash:
+        # only the downloaded files that passed the check (skipped ones returned None)
+        tohash = [fileout for fileout, isgood_ in zip(download_location, isgood)
+                      if isgood_ and os.path.isfile(fileout)]
+        for fileout, hexdigest in zip(tohash, calculate_hashes(tohash, nthreads=nprocess)):
+            calculate_and_write_hash(fileout, hexdigest=hexdigest)
             
 def download_fitsdata(url, session=None, **kwargs):
     """ download a fitsfile and get the first data (nothing stored) 
@@ -1057,28 +1559,52 @@ def download_single_url(
     overwrite=False,
     cookies=None,
     show_progress=True,
-    chunk=1024,
+    chunk=1024**2,
     wait=None,
     randomize_wait=True,
     filecheck=True,
     erasebad=True,
     write_hash=False,
+    inline_hash=True,
     **kwargs,
     ):
     """Download the url target using requests.get.
     the data is returned (if fileout is None) or stored in `fileout`
+    (the result of the file check is returned then, if filecheck)
+
+    chunk: int
+        size (in bytes) of the blocks written to `fileout`.
+        Values below MIN_DOWNLOAD_CHUNK are raised to it.
+        Without progress bar, at least COPY_BUFFERSIZE is used.
+
+    inline_hash: bool
+        if the hash is to be written (filecheck and write_hash), 
+        should it be computed while downloading ? 
+        If False, the file is read again once downloaded
+        (by download_url: all at once, see calculate_hashes).
     """
+    chunk = max(int(chunk), MIN_DOWNLOAD_CHUNK)
     
     if wait is not None:
-        waiting = wait if not randomize_wait else np.random.uniform(0, wait)
-        time.sleep(waiting)
+        if not randomize_wait:
+            time.sleep(wait)
+        elif _THROTTLING["rate"] > _THROTTLING_THRESHOLD:
+            # only spread the requests when the server is pushing back.
+            time.sleep(np.random.uniform(0, wait))
+
+    if fileout is not None and not overwrite:
+        try:
+            if stat.S_ISREG(os.stat(fileout).st_mode):
+                logger.debug(f"{fileout} already exists: skipped")
+                return
+        except FileNotFoundError:
+            pass
+        
+    if fileout:
+        logger.debug(f"downloading {url} to {fileout}")
 
-    if fileout is not None and not overwrite and os.path.isfile(fileout):
-        logger.debug(f"{fileout} already exists: skipped")
-        return
-    else:
-        if fileout:
-            logger.debug(f"downloading {url} to {fileout}")
+    if session is None:
+        session = _get_default_session()
 
     if cutouts:
         if radec is None:
@@ -1088,10 +1614,10 @@ def download_single_url(
         url += f"?center={radec[0]},{radec[1]}&size={cutout_size}arcsec&gzip=false"
 
     # = Password and Username
-    if cookies is None:
-        # this attach the cookies to the session if given
-        # and the returned 'cookies' is None
-        cookies = get_cookie(session=session, update=False) 
+    irsa_login = cookies is None
+    if irsa_login and not _has_irsa_cookies_(session):
+        # this attach the cookies to the session, no need to pass them along.
+        _ = get_cookie(session=session, update=False)
          
     # - requests options
     download_prop = {**dict(stream=True), **kwargs}
@@ -1099,47 +1625,76 @@ def download_single_url(
         download_prop["cookies"] = cookies
 
     request_fnc = "get" if not "data" in download_prop else "post"
-    requests_or_session = requests if session is None else session
+    requests_or_session = session
     
     # = Where should the data be saved?
     if fileout is not None:
         directory = os.path.dirname(fileout)
-        oldmask = os.umask(0o002)
-
-        if not os.path.exists(directory):
+        with _group_writable_():
             os.makedirs(directory, exist_ok=True)
 
     else:
         download_prop["stream"] = False
-        return getattr(requests_or_session, request_fnc)(url, **download_prop)
 
-    # With Progress bar?
-    if not show_progress:
-        response = getattr(requests_or_session, request_fnc)(url, **download_prop)
-        if response.status_code == 200:
-            with open(fileout, "wb") as f:
-                for data in response.iter_content(chunk):
-                    f.write(data)
+    response = _request_with_backoff_(getattr(requests_or_session, request_fnc),
+                                      url, **download_prop)
+    if irsa_login and response.status_code in [401, 403]:
+        # the irsa cookies may have expired, renew them once.
+        response.close()
+        _ = get_cookie(session=session, update=True)
+        response = _request_with_backoff_(getattr(requests_or_session, request_fnc),
+                                          url, **download_prop)
+
+    if fileout is None:
+        return response
+    
+    # hash computed while writing, such that the file needs not to be read again.
+    hasher = _new_hasher_() if (inline_hash and filecheck and write_hash) else None
+    if response.status_code == 200:
+        # With Progress bar? (only if the size is known)
+        total = int(response.headers.get("content-length") or 0)
+        expected_size = _expected_size_(response)
+        if not show_progress or total == 0:
+            with _open_for_write_(fileout, size=expected_size) as f:
+                out = f if hasher is None else _HashingWriter_(f, hasher)
+                buffersize = max(chunk, COPY_BUFFERSIZE)
+                if download_prop["stream"] and (expected_size is not None
+                                                and not response.raw.chunked
+                                                and hasattr(response.raw, "read1")): # urllib3>=2
+                    # plain body: write the data as it comes, without re-buffering it.
+                    for data in iter(lambda: response.raw.read1(buffersize), b""):
+                        out.write(data)
+                elif download_prop["stream"]:
+                    response.raw.decode_content = True # as iter_content does
+                    shutil.copyfileobj(response.raw, out, length=buffersize)
+                else:
+                    out.write(response.content)
 
-    else:
-        from astropy.utils.console import ProgressBar
-
-        response = getattr(requests_or_session, request_fnc)(url, **download_prop)
-        if response.status_code == 200:
-            chunk_barstep = 500
-            f = open(fileout, "wb")
-            with ProgressBar(
-                int(response.headers.get("content-length")) / (chunk_barstep * chunk),
-                ipython_widget=is_running_from_notebook(),
-            ) as bar:
-                for i, data in enumerate(response.iter_content(chunk_size=chunk)):
-                    if i % chunk_barstep == 0:
-                        bar.update()
-                    f.write(data)
-            f.close()
+        else:
+            from astropy.utils.console import ProgressBar
 
+            # bar updated from the written bytes, at most ~100 times.
+            step = max(total // 100, 1024**2)
+            written = next_tick = 0
+            with _open_for_write_(fileout, size=expected_size) as f, ProgressBar(
+                total, ipython_widget=is_running_from_notebook(),
+            ) as bar:
+                out = f if hasher is None else _HashingWriter_(f, hasher)
+                for data in response.iter_content(chunk_size=chunk):
+                    out.write(data)
+                    written += len(data)
+                    if written >= next_tick:
+                        bar.update(min(written, total))
+                        next_tick += step
+                        
+                bar.update(min(written, total))
+    else:
+        hasher = expected_size = None
+        
     if filecheck:
-        _test_file_(fileout, erasebad=erasebad, fromdl=True, write_hash=write_hash)
+        return _test_file_(fileout, erasebad=erasebad, fromdl=True, write_hash=write_hash,
+                    hexdigest=hasher.hexdigest() if hasher is not None else None,
+                    expected_size=expected_size)
 
 def test_url_exists(filename_url, session=None,cookies=None, **kwargs): 
     """ 
@@ -1158,12 +1713,14 @@ def test_url_exists(filename_url, session=None,cookies=None, **kwargs):
         bool
         True if file exists. False if status_code differs from 200.    
     """
+    if session is None:
+        session = _get_default_session()
     
     # = Password and Username
-    if cookies is None:
-        # this attach the cookies to the session if given
-        # and the returned 'cookies' is None
-        cookies = get_cookie(session=session, update=False) 
+    irsa_login = cookies is None
+    if irsa_login and not _has_irsa_cookies_(session):
+        # this attach the cookies to the session, no need to pass them along.
+        _ = get_cookie(session=session, update=False)
          
     # - requests options
     download_prop = {**dict(stream=False), **kwargs}
@@ -1171,53 +1728,321 @@ def test_url_exists(filename_url, session=None,cookies=None, **kwargs):
         download_prop["cookies"] = cookies
 
     request_fnc = "head" 
-    requests_or_session = requests if session is None else session
+    requests_or_session = session
 
     response = getattr(requests_or_session, request_fnc)(filename_url, **download_prop)
+    if irsa_login and response.status_code in [401, 403]:
+        # the irsa cookies may have expired, renew them once.
+        _ = get_cookie(session=session, update=True)
+        response = getattr(requests_or_session, request_fnc)(filename_url, **download_prop)
+        
     if response.status_code == 200 : 
         return True
     else : 
         return False
 
+def test_urls_exist(filename_urls, nthreads=16, session=None, cookies=None, **kwargs):
+    """ 
+    Test if the files associated to the given urls exist on remote IRSA server.
+    (test_url_exists ran in parallel threads sharing the same session)
+
+    Parameters
+    ----------
+    filename_urls : list
+        IRSA urls from `ztfquery.buildurl.filename_to_url` for example
+
+    nthreads: int
+        number of requests running in parallel.
+
+    session: requests.Session
+        session used to call the get method
+
+    cookies: 
+        cookies passed to the requests. If None, the irsa cookies are
+        attached to the session once, before the requests.
+
+    **kwargs goes to test_url_exists
+
+    Returns
+    -------
+    dict
+        {url: bool} (see test_url_exists)
+    """
+    if session is None:
+        session = _get_default_session()
+
+    if cookies is None:
+        if not _has_irsa_cookies_(session):
+            _ = get_cookie(session=session, update=False)
+        cookies = "no_cookies" # already in the session
+        
+    filename_urls = [str(url) for url in np.atleast_1d(filename_urls)]
+    with ThreadPoolExecutor(max_workers=nthreads) as p:
+        exist = p.map(lambda url: test_url_exists(url, session=session, cookies=cookies,
+                                                  **kwargs),
+                      filename_urls)
+        return dict(zip(filename_urls, exist))
+
+async def download_many(urls, fileouts, concurrency=16, cookies=None,
+                        overwrite=False, chunk=1024**2, filecheck=True,
+                        erasebad=True, maxtry=5, http2=True, **kwargs):
+    """ asynchronously download the urls into fileouts, sharing a single
+    httpx.AsyncClient such that connections are reused (and multiplexed
+    with http2, if the h2 package is installed).
+
+    This requires httpx (pip install httpx[http2]). 
+    See download_many_sync() to call it outside an event loop.
+
+    Parameters
+    ----------
+    urls, fileouts: list
+        urls to download and where to store them.
+
+    concurrency: int
+        maximum number of simultaneous downloads.
+
+    cookies: 
+        cookies passed to the client. 
+        If None, the irsa cookies are used (see get_cookie); 
+        use 'no_cookies' to pass none.
+
+    overwrite: bool
+        should existing fileouts be downloaded again ?
+
+    chunk: int
+        size (in bytes) of the blocks written to the fileouts.
+
+    filecheck, erasebad: bool
+        check the downloaded files (see _test_file_)
+
+    maxtry: int
+        maximum number of requests per url upon HTTP 429 (Too Many Requests).
+
+    http2: bool
+        use http2 if available.
+
+    **kwargs goes to httpx.AsyncClient
+
+    Returns
+    -------
+    None
+    """
+    try:
+        import httpx
+    except ImportError:
+        raise ImportError("You need httpx to use this function. pip install httpx[http2]")
+    import asyncio
+    from importlib.util import find_spec
+
+    urls, fileouts = np.atleast_1d(urls), np.atleast_1d(fileouts)
+    if len(urls) != len(fileouts):
+        raise ValueError("urls and fileouts must have the same size.")
+
+    if cookies is None:
+        cookies = get_cookie()
+    elif cookies in ["no_cookies"]:
+        cookies = None
+
+    chunk = max(int(chunk), MIN_DOWNLOAD_CHUNK)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def _download_(client, url, fileout):
+        """ """
+        if not overwrite and os.path.isfile(fileout):
+            logger.debug(f"{fileout} already exists: skipped")
+            return
+
+        async with semaphore:
+            logger.debug(f"downloading {url} to {fileout}")
+            sleep = _BACKOFF_BASE
+            for i in range(maxtry):
+                async with client.stream("GET", url) as response:
+                    throttled = response.status_code == 429
+                    _update_throttling_(throttled)
+                    if throttled and i < maxtry - 1:
+                        retry_after = _parse_retry_after_(response.headers.get("Retry-After"))
+                        if retry_after is not None:
+                            sleep = retry_after
+                        else:
+                            sleep = np.random.uniform(_BACKOFF_BASE, min(_BACKOFF_CAP, sleep * 3))
+                    elif response.status_code == 200:
+                        with _group_writable_():
+                            os.makedirs(os.path.dirname(fileout), exist_ok=True)
+                        expected_size = _expected_size_(response)
+                        with _open_for_write_(fileout, size=expected_size) as f:
+                            async for data in response.aiter_bytes(chunk):
+                                f.write(data)
+                        break
+                    else:
+                        return
+
+                logger.debug(f"too many requests for {url}, retrying in {sleep:.1f}s")
+                await asyncio.sleep(sleep)
+
+        if filecheck:
+            await loop.run_in_executor(None, lambda: _test_file_(fileout, erasebad=erasebad,
+                                                                  fromdl=True,
+                                                                  expected_size=expected_size))
+
+    http2 = http2 and find_spec("h2") is not None
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(http2=http2, cookies=cookies, limits=limits,
+                                 follow_redirects=True, **kwargs) as client:
+        await asyncio.gather(*[_download_(client, str(url), str(fileout))
+                               for url, fileout in zip(urls, fileouts)])
+
+
+def download_many_sync(urls, fileouts, **kwargs):
+    """ run download_many() in a new event loop. 
+
+    Within a running loop (e.g. in a notebook), rather directly 
+    `await download_many(urls, fileouts, **kwargs)`.
+
+    **kwargs goes to download_many
+    """
+    import asyncio
+    return asyncio.run(download_many(urls, fileouts, **kwargs))
+
+
 # =============== #
 #                 #
 #  HASH tools     #
 #                 #
 # =============== #
 
+def _md5_():
+    """ md5 hash object, flagged as not used for security (checksum only) 
+    such that openssl FIPS restrictions do not apply.
+    """
+    if sys.version_info >= (3, 9):
+        return hashlib.md5(usedforsecurity=False)
+    return hashlib.md5()
+
+def _hash_algo_():
+    """ the hash algorithm in use: HASH_ALGO if available, md5 otherwise """
+    return _resolve_hash_algo_(HASH_ALGO)
+
+@lru_cache(maxsize=None)
+def _resolve_hash_algo_(algo):
+    """ algo if available, md5 otherwise (checked, and warned, once per algo) """
+    if algo == "blake3":
+        try:
+            import blake3
+        except ImportError:
+            warnings.warn("You do not have blake3 (pip install blake3), md5 is used instead.")
+            return "md5"
+    elif (algo not in hashlib.algorithms_available
+              or algo.startswith("shake")): # no fixed size hexdigest
+        warnings.warn(f"unknown hash algorithm {algo}, md5 is used instead.")
+        return "md5"
+    return algo
+
+def _hash_extension_():
+    """ extension of the hash files (e.g. '.md5') """
+    return f".{_hash_algo_()}"
+
+def _new_hasher_():
+    """ new hash object following HASH_ALGO (see _hash_algo_) """
+    algo = _hash_algo_()
+    if algo == "md5":
+        return _md5_()
+    if algo == "blake3":
+        import blake3
+        return blake3.blake3()
+    return hashlib.new(algo)
+
 def calculate_hash(fname):
-    """ """
-    f = open(fname, "rb")
-    hash_md5 = hashlib.md5()
-    for chunk in iter(lambda: f.read(4096), b""):
-        hash_md5.update(chunk)
-    hexdigest = hash_md5.hexdigest()
-    f.close()
-    return hexdigest
+    """ hexdigest of the given file (see HASH_ALGO) """
+    with open(fname, "rb") as f:
+        if hasattr(hashlib, "file_digest"): # python>=3.11, reuses one buffer (readinto), hashing in C
+            return hashlib.file_digest(f, _new_hasher_).hexdigest()
+
+        hasher = _new_hasher_()
+        for chunk in iter(lambda: f.read(HASH_BUFFERSIZE), b""):
+            hasher.update(chunk)
+            
+    return hasher.hexdigest()
 
-def calculate_and_write_hash(fname):
-    """ """
-    hexdigest = calculate_hash(fname)
-    f_hash = open(f"{fname}.md5", "w")
-    f_hash.write(hexdigest)
-    f_hash.close()
+class _HashingWriter_:
+    """ file wrapper updating a hash object with all the written data """
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.fileobj.write(data)
+
+def calculate_hashes(fnames, nthreads=None):
+    """ hexdigests of the given files, computed in parallel threads
+    (hashlib releases the GIL while hashing)
+
+    Parameters
+    ----------
+    fnames: list
+        list of filepath
+
+    nthreads: int, None
+        number of threads. If None, the ThreadPoolExecutor default is used.
+
+    Returns
+    -------
+    list
+        hexdigests (same order as fnames)
+    """
+    with ThreadPoolExecutor(max_workers=nthreads) as p:
+        return list(p.map(calculate_hash, fnames))
+
+def calculate_and_write_hash(fname, hexdigest=None):
+    """ write the hexdigest of the file in its hash file, e.g. fname.md5
+    (computed unless given)
+    """
+    if hexdigest is None:
+        hexdigest = calculate_hash(fname)
+    with open(f"{fname}{_hash_extension_()}", "w") as f_hash:
+        f_hash.write(hexdigest)
+    _load_hash_index_(os.path.dirname(fname)).add(os.path.basename(fname))
 
 def read_hash(fname):
     """ """
-    f_hash = open(f"{fname}.md5", "r")
-    hash_md5 = f_hash.read()
-    return hash_md5
+    with open(f"{fname}{_hash_extension_()}", "r") as f_hash:
+        hexdigest = f_hash.read()
+    return hexdigest
 
-def compare_hash(fname):
-    """ """
-    f_hash = open(hash_fname, "r")
-    hash_md5_read = f_hash.read()
-    hash_md5_calculated = calculate_hash(fname)
-    if hash_md5_read == hash_md5_calculated:
-        return True
-    else:
-        return False
+def compare_hash(fname, computed=None):
+    """ does the hash stored in the hash file (e.g. fname.md5) match that of the file ?
+    
+    computed: hexdigest of the file, if already known 
+              (calculated otherwise)
+    """
+    if computed is None:
+        computed = calculate_hash(fname)
+    return hmac.compare_digest(read_hash(fname).strip(), computed)
+
+def _load_hash_index_(directory, reload=False):
+    """ set of the file names that have a hash file in the given directory.
+
+    The directory is read once and then kept in memory
+    (calculate_and_write_hash keeps it up to date).
+    """
+    extension = _hash_extension_()
+    key = (directory, extension)
+    if reload or key not in _HASH_INDEX:
+        try:
+            with os.scandir(directory or ".") as entries:
+                names = {entry.name[:-len(extension)] for entry in entries
+                         if entry.name.endswith(extension)}
+        except OSError:
+            names = set()
+
+        if reload:
+            _HASH_INDEX[key] = names
+        else: # first thread to load it wins.
+            return _HASH_INDEX.setdefault(key, names)
+            
+    return _HASH_INDEX[key]
 
 def hash_for_file_exists(fname):
     """ """
-    return os.path.exists(f"{fname}.md5")
+    return os.path.basename(fname) in _load_hash_index_(os.path.dirname(fname))
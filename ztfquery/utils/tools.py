@@ -1,12 +1,14 @@
 """ Generic projection and plotting tools """
 
 import numpy as np
+from functools import lru_cache
 
 _DEG2RA = np.pi / 180
 
 
+@lru_cache(maxsize=1)
 def is_running_from_notebook():
-    """ Test if currently ran in notebook """
+    """ Test if currently ran in notebook (cached, this does not change) """
     return running_from() == "notebook"
 
 def running_from():